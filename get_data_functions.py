@@ -1,4 +1,5 @@
-import os, time, pickle
+import os, time, pickle, glob, hashlib
+import multiprocessing as mp
 
 from datetime  import datetime, timedelta
 
@@ -6,18 +7,47 @@ import pandas as pd
 import xarray as xr
 import numpy  as np
 
-from multiprocessing import Process as P
-from multiprocessing import Queue   as Q
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing  import shared_memory, resource_tracker
+
+try: 
+    import dask # optional, only used by get_flux_data(use_dask=True)
+    have_dask = True
+except ImportError: have_dask = False
+
+try: 
+    import h5netcdf, h5py # optional, our files are netcdf4/hdf5 and h5netcdf opens them a good bit faster
+    nc_engine = 'h5netcdf'
+except ImportError: nc_engine = 'netcdf4'
+
+try: 
+    import pyarrow, pyarrow.ipc # optional, parquet caches and memory mapped arrow files if you have it
+    have_pyarrow = True
+except ImportError: have_pyarrow = False
+
+# daily files smaller than this are read into memory in one go when opened (unless only some needed_vars
+# are wanted), bigger ones get the usual on-demand reads so a handful of workers don't eat all the ram
+in_memory_max_bytes = 200*1024**2
+
+# netcdf4 files are hdf5 underneath and start with this. netcdf3 ones (the ARM radiation files, for
+# one) don't, and h5netcdf can't open those at all
+hdf5_signature = b'\x89HDF\r\n\x1a\n'
+
+# daily dataframes at least this big come back from the workers in shared memory, smaller ones (the slow
+# data) are quicker to just pickle over than to set up and tear down the shared blocks for
+shm_min_bytes = 32*1024**2
 
 def get_flux_data(station, start_day, end_day, level,
                   data_dir='/Projects/MOSAiC/', data_type='slow',
-                  verbose=False, nthreads=1, as_xrds=False, pickle_dir=None):
+                  verbose=False, nthreads=1, as_xrds=False, pickle_dir=None, use_dask=False,
+                  needed_vars=None, dtype_backend=None):
 
 
     """ Get a dataset from the MOSAiC flux project. 
 
     Function assumes the standard folder structure as in the NOAA archive. 
-    Supports parallelism without using heavy libraries, like dask. 
+    Supports parallelism without using heavy libraries, like dask. If you
+    do have dask, use_dask=True reads all files lazily in one go instead.
 
     Required params
     ---------------
@@ -33,10 +63,24 @@ def get_flux_data(station, start_day, end_day, level,
     nthreads    : how many cpu threads would you like to use 
     verbose     : would you like to see more print statements?
 
-    pickle_dir : if provided, we search for a pandas 'pickle' binary
-                 file containing the pre-packed pandas objects. if we
-                 don't find it, it is written after ingest. saves *a lot*
-                 of time when stored on ramdisk for bigger files.
+    pickle_dir : if provided, we search for a cache file containing the
+                 pre-packed pandas objects. if we don't find it, it is
+                 written after ingest. saves *a lot* of time when stored
+                 on ramdisk for bigger files. dataframes are cached as
+                 parquet when pyarrow is installed, everything else (and
+                 xarray datasets) as a python pickle
+
+    use_dask   : open all days with xr.open_mfdataset and let dask's thread
+                 pool do the reads, no worker processes. needs dask installed
+
+    needed_vars : list of variable names, if given only these are read from
+                  the files (names that aren't in a file are skipped). much
+                  smaller/faster if you only need a few of many variables
+
+    dtype_backend : None for the usual numpy columns, or 'pyarrow' to get
+                    pyarrow backed columns (pd.ArrowDtype, missing data is
+                    <NA>). the days are then concatted without copying them
+                    into one big array. needs pyarrow installed
 
     Returns
     -------
@@ -53,27 +97,36 @@ def get_flux_data(station, start_day, end_day, level,
         print("\n\nYou asked for a station name that doesn't exist...")
         print("... can't help you here\n\n"); raise IOError
 
+    if dtype_backend == 'pyarrow' and not have_pyarrow:
+        print("... you asked for pyarrow columns but it's not installed, you get numpy ones instead")
+        dtype_backend = None
+
     if as_xrds: data_format = 'ds'
+    elif dtype_backend == 'pyarrow': data_format = 'dfarrow' # parquet remembers the arrow types, keep them apart
     else: data_format = 'df'
 
     pickled_filename = f'{station}_{level}_{data_type}_{data_format}' # code_version is tacked on to this when run
+    if needed_vars is not None: # a subset gets its own pickle, so nobody asking for everything gets handed it
+        vars_hash = hashlib.md5(','.join(sorted(needed_vars)).encode()).hexdigest()[0:8]
+        pickled_filename = f'{station}_{level}_{data_type}_vars{vars_hash}_{data_format}'
+    if as_xrds or not have_pyarrow: pickle_ext = 'pkl'
+    else: pickle_ext = 'parquet' # written as this, columnar, compressed and stable across pandas versions
+
     df = pd.DataFrame() # dataframe and version we return from this function
     code_version = "?"
     was_pickled = False
     if pickle_dir:
         if verbose: print(f"\n!!! searching for pickle file containing {pickled_filename} and loading it, takes time...\n")
-        for root, dirs, files in os.walk(pickle_dir): # pretty stupid way to find the file
-            for filename in files:
-                if pickled_filename in filename:
-                    filename = pickle_dir+filename
-
-                    with open(filename, "rb") as f:
-                        data_obj = pickle.load(f)
-                    name_words = filename.rpartition('_')[-1].rpartition('.')
-                    code_version = f"{name_words[0]}.{name_words[1]}"
-                    was_pickled = True
-                    print(f" ... found and loaded pickle {filename} \n\n")
-                    break
+        filename = find_pickle(pickle_dir, pickled_filename, ('.parquet', '.pkl'))
+        if filename:
+            if filename.endswith('.parquet'): 
+                data_obj = pd.read_parquet(filename, engine='pyarrow')
+            else:
+                with open(filename, "rb") as f:
+                    data_obj = pickle.load(f)
+            code_version = os.path.splitext(filename)[0].rpartition('_')[-1]
+            was_pickled = True
+            print(f" ... found and loaded pickle {filename} \n\n")
 
         if not was_pickled: print("... didn't find a pickle, we'll write one !!!\n\n")
 
@@ -81,58 +134,69 @@ def get_flux_data(station, start_day, end_day, level,
         data_list = [] # data frames get appended here in loop and then concatted by function after
         day_series = pd.date_range(start_day, end_day) 
 
-        q_list = []; p_list = []; day_list = []
-        for i_day, today in enumerate(day_series): # loop over days in processing range and get list of files
-
-            if i_day %nthreads == 0:
-                if nthreads > 1:
-                    print("  ... getting data for day {} (and {} days after in parallel)".format(today,nthreads))
-                else:
-                    print("  ... getting data for day {}".format(today))
-
-            date_str = today.strftime('%Y%m%d.%H%M%S')
-            if level == 1: level_str = 'ingest'
-            if level == 2: level_str = 'product'
-            if level == 3: level_str = 'archive'
-
-            subdir   = f'/{level}_level_{level_str}_{station}/'
-            if level==3: subdir   = f'/{level}_level_{level_str}/'
-            if station == 'tower':
-                subdir   = f'/{level}_level_{level_str}/'
-                file_str = f'/mosflx{station}{data_type}.level{level}.{date_str}.nc'
-                if level in [2, 3]:
-                    #subdir = subdir+'version3/'
-                    #subdir = subdir+'finalqc/'
-                    cadence = '1'
-                    if data_type=='seb': cadence = '10'
-                    #file_str = f'/mos{data_type}.metcity.level{level}v3.{cadence}min.{date_str}.nc'
-                    file_str = f'/mos{data_type}.metcity.level{level}.4.{cadence}min.{date_str}.nc'
+        shm_list = [] # shared memory the daily dataframes live in, released after the concat
+        # the file path is the same every day except for the date, so put the rest together once...
+        if level == 1: level_str = 'ingest'
+        if level == 2: level_str = 'product'
+        if level == 3: level_str = 'archive'
+
+        subdir   = f'/{level}_level_{level_str}_{station}/'
+        if level==3: subdir   = f'/{level}_level_{level_str}/'
+        if station == 'tower':
+            subdir   = f'/{level}_level_{level_str}/'
+            file_pre = f'/mosflx{station}{data_type}.level{level}.'
+            if level in [2, 3]:
+                #subdir = subdir+'version3/'
+                #subdir = subdir+'finalqc/'
+                cadence = '1'
+                if data_type=='seb': cadence = '10'
+                #file_pre = f'/mos{data_type}.metcity.level{level}v3.{cadence}min.'
+                file_pre = f'/mos{data_type}.metcity.level{level}.4.{cadence}min.'
 
-            else:
-                file_str = f'/mos{station}{data_type}.level{level}.{date_str}.nc'
-                if level in [2, 3]:
-                    cadence = '1'
-                    if data_type=='seb': cadence = '10'
-                    file_str = f'/mos{data_type}.{station}.level{level}.4.{cadence}min.{date_str}.nc'
-                    #subdir = subdir+'/version3'
-
-
-            files_dir = data_dir+station+subdir
-            curr_file = files_dir+file_str
-
-            q_today = Q()
-            P(target=get_datafile, args=(curr_file, as_xrds , q_today),).start()
-            q_list.append(q_today)
-            day_list.append(today)
-            if (i_day+1) % nthreads == 0 or today == day_series[-1]:
-                for qq in q_list:
-                    data_today = qq.get()
-                    cv = qq.get()
-                    if cv!=None: code_version = cv # assume all files have same code version, save only one
-                    if type(data_today) in [type(pd.DataFrame()), type(xr.Dataset())]:
-                        data_list.append(data_today.copy())
-                q_list = []
-                day_list = []
+        else:
+            file_pre = f'/mos{station}{data_type}.level{level}.'
+            if level in [2, 3]:
+                cadence = '1'
+                if data_type=='seb': cadence = '10'
+                file_pre = f'/mos{data_type}.{station}.level{level}.4.{cadence}min.'
+                #subdir = subdir+'/version3'
+
+        # ... and do the dates for all of the days at once
+        files_dir = data_dir+station+subdir
+        file_list = (files_dir+file_pre+day_series.strftime('%Y%m%d.%H%M%S')+'.nc').tolist()
+
+        if use_dask and not have_dask:
+            print("... you asked for dask but it's not installed, reading with worker processes instead")
+            use_dask = False
+
+        if use_dask: 
+            print(f"  ... getting data for {len(day_series)} days with dask")
+            data_list, code_version = get_datafiles_dask(file_list, as_xrds, needed_vars)
+
+        else:
+            if nthreads > 1: print(f"  ... getting data for {len(day_series)} days, {nthreads} at a time")
+            else:            print(f"  ... getting data for {len(day_series)} days")
+
+            # one pool for all the days, a new file is handed out whenever a worker frees up. missing days
+            # are dropped here, no point starting a worker just to find out the file isn't there
+            found_files = find_existing_files(file_list)
+            data_days   = [None]*len(found_files) # keeps the days in order, futures finish whenever
+            resource_tracker.ensure_running() # before the fork, so the workers register their shm with ours
+            with ProcessPoolExecutor(nthreads, mp_context=mp.get_context('fork')) as exe:
+                future_days = {exe.submit(get_datafile, curr_file, as_xrds, needed_vars): i_day
+                               for i_day, curr_file in enumerate(found_files)}
+
+                try: 
+                    for fut in as_completed(future_days):
+                        data_today, cv = fut.result()
+                        if cv!=None: code_version = cv # assume all files have same code version, save only one
+                        if isinstance(data_today, dict): # dataframe was passed back in shared memory
+                            data_days[future_days[fut]] = df_from_shm(data_today, shm_list)
+                        elif type(data_today) in [type(pd.DataFrame()), type(xr.Dataset())]:
+                            data_days[future_days[fut]] = data_today
+                        del future_days[fut] # picked up, what's left is cleaned up below if we bail
+                finally: discard_days(future_days)
+            data_list = [d for d in data_days if d is not None]; del data_days
 
         if verbose: print("... concatting, takes some time...")
         if as_xrds: 
@@ -149,8 +213,13 @@ def get_flux_data(station, start_day, end_day, level,
             data_obj = ds
 
         else:
-            try    : df = pd.concat(data_list)
+            try    : 
+                if dtype_backend == 'pyarrow': df = arrow_concat(data_list)
+                elif len(data_list) > 1: df = pd.concat(data_list)
+                elif shm_list:           df = data_list[0].copy() # copy, so nothing points into shared memory
+                else:                    df = data_list[0]
             except : pd.DataFrame()
+            del data_list; release_shm(shm_list)
 
             try: 
                 df.index = df.index.droplevel("freq")
@@ -176,64 +245,277 @@ def get_flux_data(station, start_day, end_day, level,
             print("... copy this manually to a ramdisk somewhere for bonus speed points")
             print("... must be symlinked here to be seen by this routine")
             print("...\n... this takes a minute, patience\n\n")
-            pickle_name = f"{pickle_dir}/{pickled_filename}_{code_version[0:3]}.pkl"
-
-            with open(pickle_name, 'wb') as pf:
-                retcode = pickle.dump(data_obj, pf)#, protocol=pickle.HIGHEST_PROTOCOL)
+            pickle_name = f"{pickle_dir}/{pickled_filename}_{code_version[0:3]}"
+
+            wrote_parquet = False
+            if pickle_ext == 'parquet':
+                try: 
+                    data_obj.to_parquet(f"{pickle_name}.parquet", engine='pyarrow', compression='zstd')
+                    wrote_parquet = True
+                except Exception as e: # something in there parquet doesn't like, fine, pickle it
+                    print(f"... couldn't write parquet, pickling instead: {e}")
+
+            if not wrote_parquet:
+                with open(f"{pickle_name}.pkl", 'wb') as pf:
+                    retcode = pickle.dump(data_obj, pf)#, protocol=pickle.HIGHEST_PROTOCOL)
  
     return data_obj, code_version 
 
-def get_datafile(curr_file, as_xrds=False, q=None):
+# the files in file_list that exist, in the same order. each directory is listed once and
+# cached, instead of a stat per file, and the missing ones get reported
+def find_existing_files(file_list):
+    dir_listings = {}; found_files = []
+    for curr_file in file_list:
+        files_dir, file_name = os.path.split(curr_file)
+        if files_dir not in dir_listings:
+            try: 
+                with os.scandir(files_dir) as dir_entries:
+                    dir_listings[files_dir] = {entry.name for entry in dir_entries}
+            except OSError: dir_listings[files_dir] = set() # directory isn't there at all
+        if file_name in dir_listings[files_dir]: found_files.append(curr_file)
+        else: print(f"!!! requested file doesn't exist : {curr_file}")
+    return found_files
+
+# newest file in pickle_dir named like {pickled_filename}_{code_version}{ext}, None if there isn't one
+def find_pickle(pickle_dir, pickled_filename, extensions):
+    pickle_matches = [f for f in glob.glob(os.path.join(pickle_dir, glob.escape(pickled_filename)+'_*'))
+                      if f.endswith(extensions)]
+    if len(pickle_matches) == 0: return None
+    return max(pickle_matches, key=os.path.getmtime)
+
+# the engine to open curr_file with, nc_engine unless it's h5netcdf and the file isn't hdf5
+def file_nc_engine(curr_file):
+    if nc_engine != 'h5netcdf': return nc_engine
+    try:
+        with open(curr_file, 'rb') as f: is_hdf5 = f.read(len(hdf5_signature)) == hdf5_signature
+    except OSError: return nc_engine # open_dataset can complain about it
+    return nc_engine if is_hdf5 else 'netcdf4'
+
+# open_dataset kwargs that pull a small file into memory in one read instead of lots of little ones,
+# hdf5 'core' driver for h5netcdf and diskless for netcdf4, and tell the kernel to start prefetching it.
+# only when all of the file is going to be read anyway, big files and needed_vars subsets get the usual
+# on-demand reads of just what's asked for
+def in_memory_open_kwargs(curr_file, engine, needed_vars=None):
+    if needed_vars is not None: return {}
+    try: file_size = os.path.getsize(curr_file)
+    except OSError: return {}
+    if file_size > in_memory_max_bytes: return {}
+
+    if hasattr(os, 'posix_fadvise'): # linux only, just a hint so failing is fine
+        try:
+            fd = os.open(curr_file, os.O_RDONLY)
+            try:     os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+            finally: os.close(fd)
+        except OSError: pass
+
+    if engine == 'h5netcdf': return {'driver': 'core', 'driver_kwds': {'backing_store': False}}
+    else:                    return {'diskless': True}
 
-    if os.path.isfile(curr_file):
-        print(f'... got {curr_file}')
-        try: 
-            with xr.load_dataset(curr_file, engine='netcdf4') as xarr_ds:
-                curr_ds = xarr_ds
-                data_frame = xarr_ds.to_dataframe()
-        except Exception as e: 
-            print(curr_file, e, 'wtf, this should absolutely never happen')
-            try:
-                q.put(xr.Dataset())
+def get_datafile(curr_file, as_xrds=False, needed_vars=None):
 
-            except Exception as e:
-                return xr.Dataset()
+    """ Worker for get_flux_data(), reads one daily file, only needed_vars if given.
 
-            try:
-                q.put('unknown'); return 'unknown'
-            except:
-                return 'unknown'
+    Returns a tuple (data, code_version). Big dataframes come back as the
+    small dict from df_to_shm(), rebuild them with df_from_shm().
+    If the file doesn't exist you get (None, None).
+    """
 
-    else:
+    if not os.path.isfile(curr_file):
         print(f"!!! requested file doesn't exist : {curr_file}")
-        curr_ds = None
-        data_frame = None
+        return None, None
 
-    if as_xrds: 
+    print(f'... got {curr_file}')
+    try: 
+        # opened lazily, the variables are only read once, straight into what we return
+        engine      = file_nc_engine(curr_file)
+        open_kwargs = in_memory_open_kwargs(curr_file, engine, needed_vars)
+        with xr.open_dataset(curr_file, engine=engine, **open_kwargs) as xarr_ds:
+            try:    code_version = xarr_ds.attrs['version']
+            except: code_version = "unknown" # code version threw exception
 
-        try:    q.put(curr_ds)
-        except: return curr_ds
+            xarr_ds = select_vars(xarr_ds, needed_vars)
+            if as_xrds: data_today = xarr_ds.load()
+            else:       data_today = df_to_shm_if_big(ds_to_df(xarr_ds))
+    except Exception as e: 
+        print(curr_file, e, 'wtf, this should absolutely never happen')
+        return xr.Dataset(), 'unknown'
 
-        try:
-            code_version = curr_ds.attrs['version']
-            q.put(code_version)
-            return
-        except:
-            q.put("unknown") # code version threw exception
-            return curr_ds   # can be implicit but doesn't matter, really
-        
-    else:
-        try:    q.put(data_frame)
-        except: return data_frame
+    return data_today, code_version
 
-        try:
-            code_version = curr_ds.attrs['version']
-            q.put(code_version)
-            return
-        except:
-            q.put("unknown") # code version threw exception
-            return data_frame # can be implicit but doesn't matter, really
 
+def get_datafiles_dask(file_list, as_xrds=False, needed_vars=None):
+
+    """ Read all daily files at once with xr.open_mfdataset, the dask path of get_flux_data().
+
+    Returns a tuple ([data], code_version), a one-element list so it drops
+    into the same concat code as the daily frames from get_datafile().
+    """
+
+    found_files = find_existing_files(file_list) # open_mfdataset dies on a missing file
+    if len(found_files) == 0: return [], "?"
+
+    # one engine for all of them, so a single netcdf3 file means netcdf4 for the lot
+    engines = {file_nc_engine(f) for f in found_files}
+    engine  = engines.pop() if len(engines) == 1 else 'netcdf4'
+    # put together the same way the worker pool's days are, xr.concat(days, 'time'). combine='by_coords'
+    # merges days with different variables onto one time axis and ints come back as floats
+    try: 
+        xarr_ds = xr.open_mfdataset(found_files, combine='nested', concat_dim='time', join='outer',
+                                    data_vars='all', coords='different', compat='equals',
+                                    parallel=True, engine=engine)
+    except Exception as e: 
+        print(e, "... couldn't open these files together")
+        return [], "?"
+
+    with xarr_ds: # everything is read into memory below, so the files get closed on the way out
+        try:    code_version = xarr_ds.attrs['version']
+        except: code_version = "unknown" # code version threw exception
+
+        # one compute for all of it, ds_to_df() on the lazy dataset would be a compute per variable
+        sub_ds = select_vars(xarr_ds, needed_vars).load()
+        if as_xrds: return [sub_ds], code_version
+        else:       return [ds_to_df(sub_ds)], code_version
+
+# cut a dataset down to the variables in needed_vars that it actually has, before anything gets read
+def select_vars(xarr_ds, needed_vars):
+    if needed_vars is None: return xarr_ds
+    return xarr_ds[[v for v in needed_vars if v in xarr_ds.data_vars]]
+
+# what xarr_ds.to_dataframe() gives you, but for the usual dataset where everything is along 'time' the
+# frame is made straight from the variable arrays, no stacking into a MultiIndex and copying through 
+# the block manager. suffix gets tacked onto every column name. datasets with any other dimension (the
+# freq dimension in seb files, for example) still go through to_dataframe()
+def ds_to_df(xarr_ds, suffix=''):
+    col_names = [k for k in xarr_ds.variables if k not in xarr_ds.dims] # same columns/order as to_dataframe
+    if list(xarr_ds.dims) != ['time'] or 'time' not in xarr_ds.coords or \
+       any(xarr_ds[k].dims not in [('time',), ()] for k in col_names):
+        if suffix: return xarr_ds.to_dataframe().add_suffix(suffix)
+        else:      return xarr_ds.to_dataframe()
+
+    index = pd.Index(xarr_ds['time'].values, name='time', copy=False)
+    col_dict = {}
+    for k in col_names:
+        col_vals = xarr_ds[k].values
+        if col_vals.ndim == 0: col_vals = np.full(len(index), col_vals) # scalars are repeated, like to_dataframe
+        col_dict[k+suffix] = col_vals
+    return pd.DataFrame(col_dict, index=index, copy=False)
+
+# the fast daily dataframes are big and pickling them through a Queue costs about as much as reading the
+# file, so workers write the raw column arrays into shared memory and only send back the names of the
+# blocks plus the small stuff (index, column names). the parent then builds a dataframe on top of the 
+# shared buffers without copying anything. the blocks stay registered with the resource tracker until
+# the parent unlinks them, so whatever never gets picked up is still removed when the parent exits
+def df_to_shm(df):
+
+    dtype_groups = {} # column positions grouped by dtype, one shared block per dtype
+    other_cols   = [] # strings/objects/extension types, small, these just get pickled
+    for icol, dtype in enumerate(df.dtypes):
+        if isinstance(dtype, np.dtype) and dtype.kind in 'biufmM':
+            dtype_groups.setdefault(dtype, []).append(icol)
+        else: other_cols.append((icol, df.iloc[:, icol].array))
+
+    blocks = []
+    for dtype, positions in dtype_groups.items():
+        vals = df.iloc[:, positions].to_numpy().T # (ncols, nrows), each column is contiguous
+        shm  = shared_memory.SharedMemory(create=True, size=max(vals.nbytes, 1))
+        np.ndarray(vals.shape, dtype=dtype, buffer=shm.buf)[:] = vals
+        shm.close()
+        blocks.append((shm.name, dtype.str, vals.shape, positions))
+
+    return {'blocks': blocks, 'others': other_cols, 'index': df.index, 'columns': df.columns}
+
+def df_to_shm_if_big(df):
+    if df.memory_usage(index=False, deep=False).sum() >= shm_min_bytes: return df_to_shm(df)
+    else: return df
+
+def df_from_shm(shm_meta, shm_list):
+
+    col_dict = {} # shm handles are appended to shm_list, pass that to release_shm() when you're done
+    for shm_name, dtype_str, shape, positions in shm_meta['blocks']:
+        shm = shared_memory.SharedMemory(name=shm_name)
+        shm.unlink() # memory stays around until we close it, but nothing leaks if we die
+        shm_list.append(shm)
+        vals = np.ndarray(shape, dtype=np.dtype(dtype_str), buffer=shm.buf)
+        for irow, icol in enumerate(positions): col_dict[icol] = vals[irow]
+    for icol, col_vals in shm_meta['others']: col_dict[icol] = col_vals
+
+    df = pd.DataFrame({icol: col_dict[icol] for icol in sorted(col_dict)}, index=shm_meta['index'], copy=False)
+    df.columns = shm_meta['columns']
+    return df
+
+def release_shm(shm_list):
+    for shm in shm_list:
+        try: shm.close()
+        except BufferError: pass # something still holds a view, it's freed when that gets collected
+
+# for when a read goes sideways part way through: days that haven't started are cancelled and the
+# shared memory of the ones that finished but never got picked up is unlinked right away
+def discard_days(future_days):
+    for fut in future_days: fut.cancel()
+    for fut in future_days:
+        if fut.cancelled(): continue
+        try: data_today, cv = fut.result()
+        except BaseException: continue # nothing came back, so nothing to clean up
+        if not isinstance(data_today, dict): continue
+        for shm_name, dtype_str, shape, positions in data_today['blocks']:
+            try: 
+                shm = shared_memory.SharedMemory(name=shm_name)
+                shm.close(); shm.unlink()
+            except FileNotFoundError: pass # got as far as df_from_shm() already
+
+# pd.concat() for get_flux_data(dtype_backend='pyarrow'), the columns come back as pd.ArrowDtype. each
+# day stays its own chunk of the arrow column instead of getting copied into one big array, and columns a
+# day doesn't have are just nulls. arrow would point straight into the shared memory the days came back
+# in, which gets released right after the concat, so every day is copied once on its way in
+def arrow_concat(df_list):
+    df_list = [d for d in df_list if not d.empty]
+    if len(df_list) == 0: return pd.DataFrame()
+
+    index = df_list[0].index.append([d.index for d in df_list[1:]]) # a datetime index, not an arrow one
+    try: 
+        table = pyarrow.concat_tables([pyarrow.Table.from_pandas(d.copy(deep=True), preserve_index=False)
+                                       for d in df_list],
+                                      promote_options='permissive')
+    except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError, TypeError): # types that won't merge, or old pyarrow
+        table = pyarrow.Table.from_pandas(pd.concat(df_list), preserve_index=False)
+
+    df = table.to_pandas(types_mapper=pd.ArrowDtype)
+    df.index = index
+    return df
+
+# a big dataframe that a bunch of worker processes all need pieces of can be written once to an
+# uncompressed arrow file, each worker then memory maps it and only copies out the rows it wants. 
+# the pages are shared between all of them through the OS page cache, instead of every worker
+# getting its own pickled copy. put TMPDIR on a ramdisk and it never touches a real disk
+def df_to_arrow_file(df, arrow_file):
+    table = pyarrow.Table.from_pandas(df, preserve_index=True)
+    with pyarrow.OSFile(arrow_file, 'wb') as sink:
+        with pyarrow.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+def df_from_arrow_file(arrow_file, start=None, end=None, columns=None):
+
+    """ Memory map a file from df_to_arrow_file() and return df.loc[start:end, columns].
+
+    Same inclusive slicing as pandas on a sorted datetime index, only the
+    rows in [start, end] of the requested columns are copied into the
+    returned dataframe.
+    """
+
+    table = pyarrow.ipc.open_file(pyarrow.memory_map(arrow_file, 'r')).read_all() # zero-copy
+    index_name = table.schema.pandas_metadata['index_columns'][0]
+
+    if columns is not None: table = table.select(list(columns)+[index_name])
+
+    if start is not None or end is not None:
+        index_vals = table.column(index_name).to_numpy()
+        if start is None: i_start = 0
+        else:             i_start = np.searchsorted(index_vals, pd.Timestamp(start).to_datetime64(), 'left')
+        if end is None:   i_end = len(index_vals)
+        else:             i_end = np.searchsorted(index_vals, pd.Timestamp(end).to_datetime64(), 'right')
+        table = table.slice(i_start, max(i_end-i_start, 0))
+
+    return table.to_pandas()
 
 def get_ship_df(ship_data_dir='/Projects/MOSAiC_internal/partner_data/AWI/polarstern/WXstation/'):
 
@@ -294,17 +576,13 @@ def get_arm_radiation_data(start_day, end_day, data_dir='/Projects/MOSAiC/',
     was_pickled = False
     if pickle_dir:
         print(f"\n!!! searching for pickle file containing {pickled_filename} and loading it, takes time...\n")
-        for root, dirs, files in os.walk(pickle_dir): # pretty stupid way to find the file
-            for filename in files:
-                if pickled_filename in filename:
-                    filename = pickle_dir+ filename
-                    with open(filename, "rb") as f:
-                        df = pickle.load(f)
-                    name_words = filename.rpartition('_')[-1].rpartition('.')
-                    code_version = f"{name_words[0]}.{name_words[1]}"
-                    was_pickled = True
-                    print(f" ... found and loaded pickle {filename} \n\n")
-                    break
+        filename = find_pickle(pickle_dir, pickled_filename, ('.pkl',))
+        if filename:
+            with open(filename, "rb") as f:
+                df = pickle.load(f)
+            code_version = os.path.splitext(filename)[0].rpartition('_')[-1]
+            was_pickled = True
+            print(f" ... found and loaded pickle {filename} \n\n")
 
         if not was_pickled: print("... didn't find a pickle, we'll write one !!!\n\n")
 
@@ -312,40 +590,39 @@ def get_arm_radiation_data(start_day, end_day, data_dir='/Projects/MOSAiC/',
         df_list = [] # data frames get appended here in loop and then concatted by function after
         day_series = pd.date_range(start_day, end_day) 
 
-        q_list = []; p_list = []; day_list = []
-        for i_day, today in enumerate(day_series): # loop over days in processing range and get list of files
-
-            if i_day %nthreads == 0:
-                if nthreads > 1:
-                    print("  ... getting data for day {} (and {} days after in parallel)".format(today,nthreads))
-                else:
-                    print("  ... getting data for day {}".format(today))
-
-            date_str = today.strftime('%Y%m%d.%H%M%S')
-
-            file_str = f'/mosiceradriihimakiS3.b1.{date_str}.nc'
-            files_dir = data_dir+subdir
-            curr_file = files_dir+file_str
-
-            if verbose: 
-                print(f"  ... {curr_file}")
-            q_today = Q()
-            P(target=get_datafile, args=(curr_file, False, q_today),).start()
-            q_list.append(q_today)
-            day_list.append(today)
-            if (i_day+1) % nthreads == 0 or today == day_series[-1]:
-                for iq,qq in enumerate(q_list):
-                    df_today = qq.get()
-                    cv = qq.get()
+        shm_list = [] # shared memory the daily dataframes live in, released after the concat
+        files_dir = data_dir+subdir
+        file_list = (files_dir+'/mosiceradriihimakiS3.b1.'+day_series.strftime('%Y%m%d.%H%M%S')+'.nc').tolist()
+        if verbose: 
+            for curr_file in file_list: print(f"  ... {curr_file}")
+
+        if nthreads > 1: print(f"  ... getting data for {len(day_series)} days, {nthreads} at a time")
+        else:            print(f"  ... getting data for {len(day_series)} days")
+
+        found_files = find_existing_files(file_list)
+        df_days     = [None]*len(found_files) # keeps the days in order, futures finish whenever
+        resource_tracker.ensure_running() # before the fork, so the workers register their shm with ours
+        with ProcessPoolExecutor(nthreads, mp_context=mp.get_context('fork')) as exe:
+            future_days = {exe.submit(get_datafile, curr_file, False): i_day
+                           for i_day, curr_file in enumerate(found_files)}
+
+            try: 
+                for fut in as_completed(future_days):
+                    df_today, cv = fut.result()
                     if cv!=None: code_version = cv # assume all files have same code version, save only one
-                    if type(df_today) == type(pd.DataFrame()): 
-                        df_list.append(df_today.copy())
-                q_list = []
-                day_list = []
+                    if isinstance(df_today, dict): # dataframe was passed back in shared memory
+                        df_days[future_days[fut]] = df_from_shm(df_today, shm_list)
+                    elif isinstance(df_today, pd.DataFrame): df_days[future_days[fut]] = df_today
+                    del future_days[fut] # picked up, what's left is cleaned up below if we bail
+            finally: discard_days(future_days)
+        df_list = [d for d in df_days if d is not None]; del df_days
 
         if verbose: print("... concatting, takes some time...")
-        try    : df = pd.concat(df_list)
+        try    : 
+            if len(df_list) > 1: df = pd.concat(df_list)
+            else:                df = df_list[0].copy() # copy, so nothing points into shared memory
         except : pd.DataFrame()
+        del df_list; release_shm(shm_list)
 
         time_dates = df.index
         df['time'] = time_dates # duplicates index... but it can be convenient
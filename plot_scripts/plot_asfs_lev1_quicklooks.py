@@ -25,21 +25,19 @@
 
 from datetime  import datetime, timedelta
 
-from multiprocessing import Process as P
-from multiprocessing import Queue   as Q
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import multiprocessing as mp
 
-import os, inspect, argparse, sys, socket
+import os, inspect, argparse, sys, socket, tempfile, io
 import matplotlib as mpl
 import matplotlib.pyplot as plt
-import colorsys
+import matplotlib.dates  as mdates
 
 if '.psd.' in socket.gethostname():
     nthreads = 60 # the twins have 64 cores, it won't hurt if we use ~30
 else: nthreads = 8 # if nthreads < nplots then plotting will not be threaded
 
 # need to debug something? kills multithreading to step through function calls
-# from multiprocessing.dummy import Process as P
-# from multiprocessing.dummy import Queue   as Q
 # nthreads = 1
 
 # this is here because for some reason the default matplotlib doesn't
@@ -59,7 +57,14 @@ sys.path.insert(0,'../')
 
 from debug_functions import drop_me as dm
 import functions_library as fl 
-from get_data_functions import get_flux_data
+from get_data_functions import get_flux_data, file_nc_engine, select_vars, ds_to_df
+from get_data_functions import have_pyarrow, df_to_arrow_file, df_from_arrow_file
+
+try: 
+    from PIL import Image # optional, lets the subplots of a plot render in parallel and get pasted together
+    Image.MAX_IMAGE_PIXELS = None # these are our own plots, and they're huge on purpose
+    have_pil = True
+except ImportError: have_pil = False
 
 #import warnings
 mpl.warnings.filterwarnings("ignore", category=mpl.MatplotlibDeprecationWarning) 
@@ -196,178 +201,188 @@ def main(): # the main data crunching program
     # plot for all of leg 2.
     day_series = pd.date_range(start_time, end_time) # we're going to get date for these days between start->end
 
+    # only read what gets plotted, plus what the variables created below are made from
+    needed_vars = [var for subplot_dict in var_dict.values() for var_list in subplot_dict.values() for var in var_list]
+    needed_vars = needed_vars + ['metek_x_Avg', 'metek_y_Avg', 'sr30_swu_Irr_Avg', 'sr30_swd_Irr_Avg',
+                                 'ir20_lwu_Wm2_Avg', 'ir20_lwd_Wm2_Avg']
+
     print(f"Retreiving data from netcdf files... {data_dir}")
     df_list = []
     for station in sleds_to_plot:
         df_station, code_version = get_flux_data(station, start_time, end_time, 1,
-                                                        data_dir, 'slow', False, nthreads, pickle_dir)
+                                                        data_dir, 'slow', False, nthreads, False, pickle_dir,
+                                                        needed_vars=needed_vars)
         df_station = df_station.add_suffix('_{}'.format(station))
         df_list.append(df_station)
     df = pd.concat(df_list, axis=1)
 
-    ## create variables that we want to have 
-    for istation, curr_station in enumerate(sleds_to_plot):
-        df['net_Irr_Avg_{}'.format(curr_station)] = \
-           df['sr30_swu_Irr_Avg_{}'.format(curr_station)] \
-          -df['sr30_swd_Irr_Avg_{}'.format(curr_station)] \
-          +df['ir20_lwu_Wm2_Avg_{}'.format(curr_station)] \
-          -df['ir20_lwd_Wm2_Avg_{}'.format(curr_station)]
-
-        df['metek_horiz_Avg_{}'.format(curr_station)] = \
-          np.sqrt(df['metek_x_Avg_{}'.format(curr_station)]*df['metek_x_Avg_{}'.format(curr_station)]+
-                  df['metek_y_Avg_{}'.format(curr_station)]*df['metek_y_Avg_{}'.format(curr_station)])
-
-    make_plots_pretty('seaborn-whitegrid') # ... and higher resolution
-
-    if make_daily_plots:
-        day_delta  = pd.to_timedelta(86399999999,unit='us') # we want to go up to but not including 00:00
-        nplotthreads = int(np.floor(nthreads/len(var_dict)))
-        if (nplotthreads==0): nplotthreads=1
-        print(f"~~ making daily plots for all figures with threads {nplotthreads}~~")
-        print("----------------------------------------------------")
-        for i_day, start_day in enumerate(day_series):
-            if i_day % nplotthreads!=0 or i_day>len(day_series): continue
-            print("  ... plotting data for day {} (and {} days *with {} plots* after in parallel)".format(start_day, nplotthreads, len(var_dict)))
-
-            plot_q_list = []; plot_p_list = []
-            for ithread in range(0,nplotthreads):
-                today     = start_day + timedelta(ithread)
-                tomorrow  = today+day_delta
-                start_str = today.strftime('%Y-%m-%d') # get date string for file name
-                end_str   = (today+timedelta(1)).strftime('%Y-%m-%d')   # get date string for file name
-
-                plot_q_list.append({}); plot_p_list.append({});
-                for plot_name, subplot_dict in var_dict.items():
-                    plot_q_list[ithread][plot_name] = Q()
-                    save_str  ='{}/{}/MOSAiC_ASFS_{}_{}_to_{}.png'.format(out_dir_daily, plot_name, plot_name, start_str, end_str)
-
-                    plot_p_list[ithread][plot_name] = \
-                      P(target=make_plot,
-                        args=(df[today:tomorrow].copy(), subplot_dict, unit_dict[plot_name],
-                              color_dict[plot_name],save_str,True,
-                              plot_q_list[ithread][plot_name])).start()
-
-
-            for ithread in range(0, nplotthreads):
-                for plot_name, subplot_dict in var_dict.items():
-                    plot_q_list[ithread][plot_name].get()
-
-    make_plots_pretty('ggplot')
-    if make_leg_plots:
-        print("   ... making leg plots for ",end='', flush=True)
-        leg_names = ["leg1","leg2","leg3","leg4","leg5"]
-        for ileg in range(0,len(leg_list)-1):
-            print(" {}...".format(leg_names[ileg]),end='', flush=True)
-            leg_dir   = "{}/{}_complete".format(quicklooks_dir,leg_names[ileg])
-            start_day = leg_list[ileg]; start_str = start_day.strftime('%Y-%m-%d') # get date string for file name
-            end_day   = leg_list[ileg+1]; end_str = end_day.strftime('%Y-%m-%d')   # get date string for file name
-
-            ifig = -1
-            plot_q_dict = {}; plot_p_dict = {}
-            for plot_name, subplot_dict in var_dict.items():
-
-                ifig += 1; plot_q_dict[plot_name] = Q()
-                save_str  ='{}/MOSAiC_ASFS_{}_{}_to_{}.png'.format(leg_dir, plot_name, start_str, end_str)
-                plot_p_dict[plot_name] = P(target=make_plot,
-                                           args=(df[start_day:end_day].copy(),subplot_dict,unit_dict[plot_name],
-                                                 color_dict[plot_name],save_str, False,plot_q_dict[plot_name])).start()
-
-            for plot_name, subplot_dict in var_dict.items():
-                plot_q_dict[plot_name].get()
+    ## create variables that we want to have, for all stations at once on (ntime, nstation) arrays
+    station_vals = lambda var: df[['{}_{}'.format(var, curr_station) for curr_station in sleds_to_plot]].values
+    station_cols = lambda var: ['{}_{}'.format(var, curr_station) for curr_station in sleds_to_plot]
 
-    # make plots for range *actually* requested when calling scripts
-    start_str = start_time.strftime('%Y-%m-%d') # get date string for file name
-    end_str   = end_time.strftime('%Y-%m-%d')   # get date string for file name
+    df[station_cols('net_Irr_Avg')] = station_vals('sr30_swu_Irr_Avg') - station_vals('sr30_swd_Irr_Avg') \
+                                     +station_vals('ir20_lwu_Wm2_Avg') - station_vals('ir20_lwd_Wm2_Avg')
 
-    ifig = -1
-    plot_q_dict = {}; plot_p_dict = {}
-    for plot_name, subplot_dict in var_dict.items():
-        ifig += 1; plot_q_dict[plot_name] = Q()
-        save_str  ='{}/MOSAiC_ASFS_{}_{}_to_{}.png'.format(out_dir_all_days, plot_name, start_str, end_str)
-        plot_p_dict[plot_name] = P(target=make_plot,
-                                   args=(df[start_time:end_time].copy(), subplot_dict, unit_dict[plot_name],
-                                         color_dict[plot_name], save_str,False,plot_q_dict[plot_name])).start()
+    df[station_cols('metek_horiz_Avg')] = np.hypot(station_vals('metek_x_Avg'), station_vals('metek_y_Avg'))
 
+    # each plot only gets handed the columns it actually draws, for every station 
+    needed_cols = {}
     for plot_name, subplot_dict in var_dict.items():
-        plot_q_dict[plot_name].get()
+        needed_cols[plot_name] = [var+'_'+curr_station for var_list in subplot_dict.values() for var in var_list
+                                  for curr_station in sleds_to_plot if var+'_'+curr_station in df.columns]
+
+    palette_dict = {plot_name: get_palette(colors) for plot_name, colors in color_dict.items()}
+
+    # the plot workers memory map df from this file and pull out their own time range, so we don't
+    # pickle a copy of df over to every single plot. set TMPDIR to a ramdisk if you've got one
+    df_file = None
+    try: 
+        if have_pyarrow:
+            df_fd, df_file = tempfile.mkstemp(suffix='.arrow', prefix='asfs_lev1_quicklooks_'); os.close(df_fd)
+            df_to_arrow_file(df, df_file)
+
+        make_plots_pretty('seaborn-whitegrid') # ... and higher resolution
+
+        # a plot worker needs a core to itself and a lot of memory, so never more of them than cores. the
+        # daily plots are queued a few days at a time instead of all at once, so memory stays bounded 
+        nplotthreads = min(nthreads, os.cpu_count() or 1) # cpu_count() is None if it can't tell
+        max_pending  = 2*nplotthreads
+
+        if make_daily_plots:
+            day_delta  = pd.to_timedelta(86399999999,unit='us') # we want to go up to but not including 00:00
+            print(f"~~ making daily plots for all figures with threads {nplotthreads}~~")
+            print("----------------------------------------------------")
+
+            # the pool gets made after make_plots_pretty() so the forked workers come up with the right style
+            with ProcessPoolExecutor(nplotthreads, mp_context=mp.get_context('fork')) as plot_pool:
+                plot_futures = []
+                for i_day, today in enumerate(day_series):
+                    tomorrow  = today+day_delta
+                    start_str = today.strftime('%Y-%m-%d') # get date string for file name
+                    end_str   = (today+timedelta(1)).strftime('%Y-%m-%d')   # get date string for file name
+
+                    for plot_name, subplot_dict in var_dict.items():
+                        save_str  ='{}/{}/MOSAiC_ASFS_{}_{}_to_{}.png'.format(out_dir_daily, plot_name, plot_name, start_str, end_str)
+                        plot_futures.append(submit_plot(plot_pool, df, df_file, today, tomorrow, needed_cols[plot_name],
+                                                         subplot_dict, unit_dict[plot_name], palette_dict[plot_name],
+                                                         save_str, True))
+                    plot_futures = wait_for_plots(plot_pool, plot_futures, max_pending)
+                wait_for_plots(plot_pool, plot_futures)
+
+        make_plots_pretty('ggplot')
+        with ProcessPoolExecutor(nplotthreads, mp_context=mp.get_context('fork')) as plot_pool:
+            plot_futures = []
+            if make_leg_plots:
+                print("   ... making leg plots for ",end='', flush=True)
+                leg_names = ["leg1","leg2","leg3","leg4","leg5"]
+                for ileg in range(0,len(leg_list)-1):
+                    print(" {}...".format(leg_names[ileg]),end='', flush=True)
+                    leg_dir   = "{}/{}_complete".format(quicklooks_dir,leg_names[ileg])
+                    start_day = leg_list[ileg]; start_str = start_day.strftime('%Y-%m-%d') # get date string for file name
+                    end_day   = leg_list[ileg+1]; end_str = end_day.strftime('%Y-%m-%d')   # get date string for file name
+
+                    for plot_name, subplot_dict in var_dict.items():
+                        save_str  ='{}/MOSAiC_ASFS_{}_{}_to_{}.png'.format(leg_dir, plot_name, start_str, end_str)
+                        plot_futures.append(submit_plot(plot_pool, df, df_file, start_day, end_day, needed_cols[plot_name],
+                                                         subplot_dict, unit_dict[plot_name], palette_dict[plot_name],
+                                                         save_str, False))
+
+            # make plots for range *actually* requested when calling scripts
+            start_str = start_time.strftime('%Y-%m-%d') # get date string for file name
+            end_str   = end_time.strftime('%Y-%m-%d')   # get date string for file name
 
+            for plot_name, subplot_dict in var_dict.items():
+                save_str  ='{}/MOSAiC_ASFS_{}_{}_to_{}.png'.format(out_dir_all_days, plot_name, start_str, end_str)
+                plot_futures.append(submit_plot(plot_pool, df, df_file, start_time, end_time, needed_cols[plot_name],
+                                                 subplot_dict, unit_dict[plot_name], palette_dict[plot_name],
+                                                 save_str, False))
+            wait_for_plots(plot_pool, plot_futures)
+
+    finally: # the whole dataset is in there, so don't leave it behind if something blew up or got ctrl-c'd
+        if df_file: os.remove(df_file)
     plt.close('all') # closes figure before looping again 
     exit() # end main()
 
-def get_asfs_data(curr_file, curr_station, today, q):
+def get_asfs_data(curr_file, curr_station, today, needed_vars=None):
 
     if os.path.isfile(curr_file):
-        xarr_ds = xr.open_dataset(curr_file)
-        data_frame = xarr_ds.to_dataframe()
-        data_frame = data_frame.add_suffix('_{}'.format(curr_station))
-        code_version = xarr_ds.attrs['version']
+        with xr.open_dataset(curr_file, engine=file_nc_engine(curr_file)) as xarr_ds:
+            data_frame = ds_to_df(select_vars(xarr_ds, needed_vars), '_{}'.format(curr_station))
+            code_version = xarr_ds.attrs['version']
     else:
         print(' !!! file {} not found for date {}'.format(curr_file,today))
         data_frame   = pd.DataFrame()
         code_version = None
-    q.put(data_frame)
-    q.put(code_version)
-    return # can be implicit
+    return data_frame, code_version
+
+# hand the plot for the time range [start, end] and columns cols to the pool. with df_file the worker
+# slices it out of the memory mapped file itself, otherwise it gets sent just that piece of df. the long
+# (leg/all days) plots with more than one subplot get a worker per subplot, they're few and slow so that
+# shortens the tail, and wait_for_plots() pastes them together. splitting costs a bit more cpu overall, 
+# so the daily plots, which keep every worker busy on their own, are made whole
+def submit_plot(plot_pool, df, df_file, start, end, cols, subplot_dict, units, colors, save_str, daily):
+    if daily or not have_pil or len(subplot_dict) == 1:
+        return submit_plot_func(plot_pool, make_plot, df, df_file, start, end, cols,
+                                subplot_dict, units, colors, save_str, daily)
+
+    subplot_futures = []; ivar = 0
+    for isub, (subplot_name, var_list) in enumerate(subplot_dict.items()):
+        sub_cols = [col for col in cols if col.rpartition('_')[0] in var_list]
+        subplot_futures.append(submit_plot_func(plot_pool, make_subplot, df, df_file, start, end, sub_cols,
+                                                subplot_name, var_list, units[subplot_name],
+                                                colors[ivar:ivar+len(var_list)], daily,
+                                                isub, len(subplot_dict)))
+        ivar+=len(var_list)
+    return (subplot_futures, save_str) 
+
+def submit_plot_func(plot_pool, plot_func, df, df_file, start, end, cols, *plot_args):
+    if df_file: return plot_pool.submit(plot_from_file, plot_func, df_file, start, end, cols, *plot_args)
+    else:       return plot_pool.submit(plot_func, df.loc[start:end, cols], *plot_args)
+
+def plot_from_file(plot_func, df_file, start, end, cols, *plot_args):
+    return plot_func(df_from_arrow_file(df_file, start, end, cols), *plot_args)
+
+# collect plots handed to the pool until no more than max_pending are left unfinished, returns those. once
+# all the subplots of a plot are done, the pasting them together goes back to the pool as its own job. a
+# plot that blows up gets reported instead of taking the rest down
+def wait_for_plots(plot_pool, plot_futures, max_pending=0):
+    pending = list(plot_futures)
+    while len(pending) > max_pending:
+        # only the ones still running, a finished subplot would have wait() return straight away
+        wait([fut for plot in pending for fut in (plot[0] if isinstance(plot, tuple) else [plot]) 
+              if not fut.done()], return_when=FIRST_COMPLETED)
+
+        still_pending = []
+        for plot in pending:
+            if isinstance(plot, tuple): 
+                subplot_futures, save_str = plot
+                if not all(fut.done() for fut in subplot_futures): still_pending.append(plot); continue
+                try: 
+                    subplot_pngs = [fut.result() for fut in subplot_futures]
+                    still_pending.append(plot_pool.submit(combine_subplots, subplot_pngs, save_str))
+                except Exception as e: print(f"!!! a plot failed and wasn't made: {e}")
+            elif not plot.done(): still_pending.append(plot)
+            else: 
+                try: plot.result()
+                except Exception as e: print(f"!!! a plot failed and wasn't made: {e}")
+        pending = still_pending
+    return pending
 
 # abstract plotting to function so plots are made iteratively according to the keys and values in subplot_dict and
 # the supplied df and df.index.... i.e. this plots the full length of time available in the supplied df
-def make_plot(df, subplot_dict, units, colors, save_str, daily, q):
+def make_plot(df, subplot_dict, units, colors, save_str, daily, max_plot_points=200000):
 
     nsubs = len(subplot_dict)
     if daily: fig, ax = plt.subplots(nsubs,1,figsize=(80,40*nsubs))  # square-ish, for daily detail
     else:     fig, ax = plt.subplots(nsubs,1,figsize=(160,30*nsubs)) # more oblong for long time series
+    ax = np.atleast_1d(ax)
 
     # loop over subplot list and plot all variables for each subplot
-    ivar = -1; isub = -1
-    for subplot_name, var_list in subplot_dict.items():
-        isub+=1
-        legend_additions = [] # uncomment code below to add the percent of missing data to the legend
-
-        for var in var_list:
-            ivar+=1
-            #print(f"{var}")
-            #print(f"and {colors[ivar]}")
-            if isinstance(colors[ivar],str) or isinstance(colors[ivar][0],float) :
-                color_tuples = get_rgb_trio(colors[ivar])
-            else:
-                color_tuples = list(colors[ivar])
-
-            color_tuples = normalize_luminosity(color_tuples)
-
-            for istation, curr_station in enumerate(sleds_to_plot):
-                try:
-                    asfs_var   = var+'_{}'.format(curr_station)
-                    asfs_color = color_tuples[istation]
-                    perc_miss  = fl.perc_missing(df[asfs_var])
-
-                    time_lims = (df.index[0], df.index[-1]+(df.index[-1]-df.index[-2])) 
-                    df[asfs_var].plot(xlim=time_lims, ax=ax[isub], color=asfs_color)
-                    legend_additions.append('{} (missing '.format(asfs_var)+str(perc_miss)+'%)')
-                    plot_success = True
-
-                except Exception as e:
-                    #import traceback
-                    #traceback.print_exc()
-                    legend_additions.append('{} (no data)'.format(asfs_var))
-                    continue
-
-        #add useful data info to legend
-        j = 0 
-        h,l = ax[isub].get_legend_handles_labels()
-        for s in range(0,len(l)):
-            l[s] = legend_additions[s]
-
-        #ax[isub].legend(l, loc='upper right',facecolor=(0.3,0.3,0.3,0.5),edgecolor='white')
-        ax[isub].legend(l, loc='best',facecolor=(0.3,0.3,0.3,0.5),edgecolor='white')    
-        ax[isub].set_ylabel('{} [{}]'.format(subplot_name, units[subplot_name]))
-        ax[isub].grid(b=True, which='major', color='grey', linestyle='-')
-        #ax[isub].grid(b=False, which='minor')
-
-        if isub==len(subplot_dict)-1:
-            ax[isub].set_xlabel('date [UTC]', labelpad=-0)
-        else:
-            ax[isub].tick_params(which='both',labelbottom=False)
-            ax[isub].set_xlabel('', labelpad=-200)
+    ivar = 0
+    for isub, (subplot_name, var_list) in enumerate(subplot_dict.items()):
+        draw_subplot(ax[isub], df, subplot_name, var_list, units[subplot_name], colors[ivar:ivar+len(var_list)],
+                     isub==nsubs-1, max_plot_points)
+        ivar+=len(var_list)
 
     fig.text(0.5, 0.005,'(plotted on {} from level1 data version {} )'.format(datetime.today(), code_version),
              ha='center')
@@ -378,46 +393,164 @@ def make_plot(df, subplot_dict, units, colors, save_str, daily, q):
     #print('... saving to: {}'.format(save_str))
     if not os.path.isdir(os.path.dirname(save_str)):
         print("!!! making directory {}... hope that's what you intended".format(os.path.dirname(save_str)))
-        os.makedirs(os.path.dirname(save_str))
+        os.makedirs(os.path.dirname(save_str), exist_ok=True) # another plot process might beat us to it
 
     fig.savefig(save_str)
         
     plt.close() # closes figure before exiting
-    q.put(True)
-    return # not necessary
+    return True
 
-def normalize_luminosity(color_tuples):
-    return_colors = []
-    pre_lume_list = [colorsys.rgb_to_hls(r,g,b)[1] for r,g,b in color_tuples]
-    for r,g,b in color_tuples: 
-        h,l,s = colorsys.rgb_to_hls(r,g,b)
-        if l == min(pre_lume_list): return_colors.append(colorsys.hls_to_rgb(h, 0.75, s))
-        elif l==max(pre_lume_list): return_colors.append(colorsys.hls_to_rgb(h, 0.25, s))
-        else:                       return_colors.append(colorsys.hls_to_rgb(h, 0.5, s))
-
-    return return_colors
-
-# returns 3 rgb tuples of varying darkness for a given color, 
-def get_rgb_trio(color):
-    if isinstance(color, str):
-        rgb = hex_to_rgb(color)
-    else: rgb = color
-    r=rgb[0]; g=rgb[1]; b=rgb[2]
-    lume = np.sqrt(0.299*r**22 + 0.587*g**2 + 0.114*b**2)
-    h,l,s = colorsys.rgb_to_hls(r,g,b)
-    if(lume>0.5): 
-        col_one = colorsys.hls_to_rgb(h, l, s)
-        col_two = colorsys.hls_to_rgb(h, l-0.2, s)
-        col_thr = colorsys.hls_to_rgb(h, l-0.4, s)
+# the same thing as a single subplot of make_plot, drawn on a figure of its own and returned as png 
+# bytes for combine_subplots() to stack with the others, lightly compressed since it gets redone there.
+# the right margin is fixed and the left one is at least margin_inches[0], so the time axes of all the
+# subplots line up after pasting, unless a y axis has labels too wide to fit in that 
+def make_subplot(df, subplot_name, var_list, unit, colors, daily, isub, nsubs,
+                 max_plot_points=200000, margin_inches=(15, 4)):
+
+    if daily: fig_size = (80,40)  # square-ish, for daily detail
+    else:     fig_size = (160,30) # more oblong for long time series
+    fig, ax = plt.subplots(1,1,figsize=fig_size)
+
+    draw_subplot(ax, df, subplot_name, var_list, unit, colors, isub==nsubs-1, max_plot_points)
+
+    if isub==nsubs-1: # same spot it would be on the whole figure
+        fig.text(0.5, 0.005*nsubs,'(plotted on {} from level1 data version {} )'.format(datetime.today(), code_version),
+                 ha='center')
+
+    fig.tight_layout(pad=2.0)
+    fig.subplots_adjust(left=max(fig.subplotpars.left, margin_inches[0]/fig_size[0]),
+                        right=1-margin_inches[1]/fig_size[0])
+    png_buf = io.BytesIO()
+    fig.savefig(png_buf, format='png', pil_kwargs={'compress_level': 1})
+        
+    plt.close() # closes figure before exiting
+    return png_buf.getvalue()
+
+# stacks the subplot pngs from make_subplot() into one png, top to bottom
+def combine_subplots(subplot_pngs, save_str):
+    subplot_images = [Image.open(io.BytesIO(png)) for png in subplot_pngs]
+    combined = Image.new('RGBA', (max(im.width for im in subplot_images),
+                                  sum(im.height for im in subplot_images)), 'white')
+    y_offset = 0
+    for im in subplot_images: 
+        combined.paste(im, (0, y_offset)); y_offset+=im.height
+
+    #print('... saving to: {}'.format(save_str))
+    if not os.path.isdir(os.path.dirname(save_str)):
+        print("!!! making directory {}... hope that's what you intended".format(os.path.dirname(save_str)))
+        os.makedirs(os.path.dirname(save_str), exist_ok=True) # another plot process might beat us to it
+    combined.save(save_str)
+    return True
+
+# plots all the variables in var_list for every station on ax, with the legend, labels and date ticks
+def draw_subplot(ax, df, subplot_name, var_list, unit, colors, last_subplot, max_plot_points=200000):
+
+    legend_additions = [] # uncomment code below to add the percent of missing data to the legend
+    for ivar, var in enumerate(var_list):
+        color_tuples = colors[ivar] # one color per station, from get_palette()
+
+        for istation, curr_station in enumerate(sleds_to_plot):
+            try:
+                asfs_var   = var+'_{}'.format(curr_station)
+                asfs_color = color_tuples[istation]
+                perc_miss  = fl.perc_missing(df[asfs_var])
+
+                time_lims = (df.index[0], df.index[-1]+(df.index[-1]-df.index[-2])) 
+
+                # nobody can see more than a couple hundred thousand points on a plot anyway
+                stride   = int(np.ceil(len(df.index)/max_plot_points))
+                plot_var = df[asfs_var].iloc[::stride]
+                ax.plot(plot_var.index.values, plot_var.values, color=asfs_color, label=asfs_var,
+                        rasterized=True)
+                ax.set_xlim(time_lims)
+                legend_additions.append('{} (missing '.format(asfs_var)+str(perc_miss)+'%)')
+                plot_success = True
+
+            except Exception as e:
+                #import traceback
+                #traceback.print_exc()
+                legend_additions.append('{} (no data)'.format(asfs_var))
+                continue
+
+    #add useful data info to legend
+    j = 0 
+    h,l = ax.get_legend_handles_labels()
+    for s in range(0,len(l)):
+        l[s] = legend_additions[s]
+
+    #ax.legend(l, loc='upper right',facecolor=(0.3,0.3,0.3,0.5),edgecolor='white')
+    ax.legend(l, loc='best',facecolor=(0.3,0.3,0.3,0.5),edgecolor='white')    
+    ax.set_ylabel('{} [{}]'.format(subplot_name, unit))
+    ax.grid(b=True, which='major', color='grey', linestyle='-')
+
+    date_locator = mdates.AutoDateLocator() # pandas did the date ticks for us when it did the plotting
+    ax.xaxis.set_major_locator(date_locator)
+    ax.xaxis.set_major_formatter(mdates.ConciseDateFormatter(date_locator))
+    #ax.grid(b=False, which='minor')
+
+    if last_subplot:
+        ax.set_xlabel('date [UTC]', labelpad=-0)
     else:
-        col_one = colorsys.hls_to_rgb(h, l+0.4, s)
-        col_two = colorsys.hls_to_rgb(h, l+0.2, s)
-        col_thr = colorsys.hls_to_rgb(h, l, s)
-    return [col_one, col_two, col_thr]
+        ax.tick_params(which='both',labelbottom=False)
+        ax.set_xlabel('', labelpad=-200)
+
+# turns a color_dict entry into the station colors for each variable, done once up front for every plot.
+# comes back as an (nvar, 3 stations, rgb) array, all of the color math is done on whole arrays at once
+def get_palette(colors):
+    is_trio = np.array([not (isinstance(color,str) or isinstance(color[0],float)) for color in colors])
+    palette = np.empty((len(colors), 3, 3))
+    if (~is_trio).any(): 
+        palette[~is_trio] = get_rgb_trio(np.array([hex_to_rgb(color) if isinstance(color,str) else color
+                                                   for color, trio in zip(colors, is_trio) if not trio]))
+    if is_trio.any(): 
+        palette[is_trio]  = np.array([color for color, trio in zip(colors, is_trio) if trio], dtype=float)
+    return normalize_luminosity(palette)
+
+# the darkest color of each trio gets light, the lightest gets dark and the one in between gets medium
+def normalize_luminosity(color_tuples):
+    hls  = rgb_to_hls(color_tuples)
+    lume = hls[...,1]
+    hls[...,1] = np.where(lume == lume.min(axis=-1, keepdims=True), 0.75,
+                          np.where(lume == lume.max(axis=-1, keepdims=True), 0.25, 0.5))
+    return hls_to_rgb(hls)
+
+# returns 3 rgb tuples of varying darkness for each of the given (n,3) rgb colors, shape (n,3,3)
+def get_rgb_trio(rgb):
+    r=rgb[...,0]; g=rgb[...,1]; b=rgb[...,2]
+    lume = np.sqrt(0.299*r*r + 0.587*g*g + 0.114*b*b)
+    hls  = np.repeat(rgb_to_hls(rgb)[...,np.newaxis,:], 3, axis=-2)
+    hls[...,1] += np.where(lume[...,np.newaxis]>0.5, [0, -0.2, -0.4], [0.4, 0.2, 0])
+    return hls_to_rgb(hls)
+
+# colorsys.rgb_to_hls/hls_to_rgb, but for arrays of colors along the last axis
+def rgb_to_hls(rgb):
+    rgb  = np.asarray(rgb, dtype=float)
+    r=rgb[...,0]; g=rgb[...,1]; b=rgb[...,2]
+    maxc = rgb.max(axis=-1); minc = rgb.min(axis=-1)
+    sumc = maxc+minc; rangec = maxc-minc
+    l    = sumc/2.0
+    with np.errstate(divide='ignore', invalid='ignore'): # greys, taken care of below
+        s  = np.where(l <= 0.5, rangec/sumc, rangec/(2.0-sumc))
+        rc = (maxc-r)/rangec; gc = (maxc-g)/rangec; bc = (maxc-b)/rangec
+    h = np.where(r == maxc, bc-gc, np.where(g == maxc, 2.0+rc-bc, 4.0+gc-rc))
+    h = (h/6.0) % 1.0
+    grey = minc == maxc
+    return np.stack([np.where(grey, 0.0, h), l, np.where(grey, 0.0, s)], axis=-1)
+
+def hls_to_rgb(hls):
+    hls = np.asarray(hls, dtype=float)
+    h=hls[...,0]; l=hls[...,1]; s=hls[...,2]
+    m2 = np.where(l <= 0.5, l*(1.0+s), l+s-(l*s))
+    m1 = 2.0*l-m2
+    def hue_to_rgb(hue):
+        hue = hue % 1.0
+        return np.select([hue < 1/6, hue < 0.5, hue < 2/3], [m1+(m2-m1)*hue*6.0, m2, m1+(m2-m1)*(2/3-hue)*6.0], m1)
+    rgb = np.stack([hue_to_rgb(h+1/3), hue_to_rgb(h), hue_to_rgb(h-1/3)], axis=-1)
+    return np.where((s == 0)[...,np.newaxis], l[...,np.newaxis], rgb)
 
 def hex_to_rgb(hex_color):
     rgb_tuple = tuple(int(hex_color.lstrip('#')[i:i+2], 16) for i in (0, 2, 4))
-    return tuple(map(lambda x: x/256.0, rgb_tuple))
+    return tuple(map(lambda x: x/255.0, rgb_tuple))
 
 def make_plots_pretty(style_name):
     # plt.style.use('ggplot')            # grey grid with bolder colors
@@ -450,6 +583,11 @@ def make_plots_pretty(style_name):
     mpl.rcParams['axes.spines.top']     = False
     mpl.rcParams['legend.facecolor']    = 'white'
 
+    # long time series are millions of line segments, let agg merge the ones you can't see anyway
+    mpl.rcParams['path.simplify']           = True
+    mpl.rcParams['path.simplify_threshold'] = 1.0
+    mpl.rcParams['agg.path.chunksize']      = 10000
+
 # this runs the function main as the main program... this is a hack that allows functions
 # to come after the main code so it presents in a more logical, C-like, way 
 if __name__ == '__main__': 